@@ -1,11 +1,15 @@
-from datetime import datetime, timedelta
-from typing import Optional, Tuple
-from zoneinfo import ZoneInfo
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
 
 import streamlit as st
 
 from database import WeightDatabase
-from models import WeightRecord
+from models import JST, WeightRecord
+
+# 食後経過時間の選択肢 (描画ごとの再生成を避けるため事前に構築)
+_TIME_AFTER_MEAL_MAP = dict(WeightRecord.TIME_AFTER_MEAL_OPTIONS)
+_TIME_AFTER_MEAL_KEYS = [t[0] for t in WeightRecord.TIME_AFTER_MEAL_OPTIONS]
+_TIME_AFTER_MEAL_INDEX = {v: i for i, v in enumerate(_TIME_AFTER_MEAL_KEYS)}
 
 
 class WeightInputForm:
@@ -29,7 +33,8 @@ class WeightInputForm:
             st.subheader("体重を記録")
 
             # 日付入力 - 日本時間で現在時刻を取得
-            today = datetime.now(ZoneInfo("Asia/Tokyo")).date()
+            now = datetime.now(JST)
+            today = now.date()
             input_date = st.date_input("日付", value=today)
 
             # 体重入力
@@ -42,12 +47,11 @@ class WeightInputForm:
             )
 
             # 食後経過時間の選択
-            time_after_meal = st.selectbox(
+            time_after_meal = st.radio(
                 "食後経過時間",
-                options=[t[0] for t in WeightRecord.TIME_AFTER_MEAL_OPTIONS],
-                format_func=lambda x: dict(
-                    WeightRecord.TIME_AFTER_MEAL_OPTIONS
-                )[x],
+                options=_TIME_AFTER_MEAL_KEYS,
+                format_func=_TIME_AFTER_MEAL_MAP.__getitem__,
+                horizontal=True,
             )
 
             # 送信ボタン
@@ -56,20 +60,22 @@ class WeightInputForm:
             if submit and weight > 0:
                 # タイムスタンプを日本時間で生成
                 timestamp = (
-                    datetime.now(ZoneInfo("Asia/Tokyo"))
+                    now
                     if input_date == today
                     else datetime.combine(
                         input_date, datetime.min.time()
-                    ).replace(tzinfo=ZoneInfo("Asia/Tokyo"))
+                    ).replace(tzinfo=JST)
                 )
                 if self.db.add_record(weight, time_after_meal, timestamp):
                     st.success("記録を保存しました")
-                    st.rerun()
 
 
 class DateRangeSelector:
     """
     期間選択コンポーネント
+
+    日付入力とクイック選択はフォームにまとめ、「適用」ボタンを
+    押したときのみ表示期間を更新する
     """
 
     QUICK_PERIODS = [
@@ -81,6 +87,66 @@ class DateRangeSelector:
         ("12か月", 365),
     ]
 
+    PERIOD_PLACEHOLDER = "ドロップダウンから表示期間の指定も可"
+
+    @staticmethod
+    def _to_datetime_range(
+        start_date: date, end_date: date
+    ) -> Tuple[datetime, datetime]:
+        """
+        日付の範囲を日本時間のdatetimeの範囲に変換
+
+        Parameters
+        ----------
+        start_date : date
+            開始日
+        end_date : date
+            終了日
+
+        Returns
+        -------
+        Tuple[datetime, datetime]
+            開始日の0時と終了日の終わり
+        """
+        start_datetime = datetime.combine(
+            start_date, datetime.min.time()
+        ).replace(tzinfo=JST)
+        end_datetime = datetime.combine(end_date, datetime.max.time()).replace(
+            tzinfo=JST
+        )
+        return start_datetime, end_datetime
+
+    @staticmethod
+    def _apply():
+        """
+        「適用」ボタン押下時に入力内容から表示期間を更新する
+        """
+        now = datetime.now(JST)
+        start_date = st.session_state.date_range_start_input
+        end_date = st.session_state.date_range_end_input
+
+        # クイック選択が指定された場合はそちらを優先し、日付入力にも反映
+        days = dict(DateRangeSelector.QUICK_PERIODS).get(
+            st.session_state.date_range_period
+        )
+        if days is not None:
+            start_date = (now - timedelta(days=days)).date()
+            end_date = now.date()
+            st.session_state.date_range_start_input = start_date
+            st.session_state.date_range_end_input = end_date
+            st.session_state.date_range_period = (
+                DateRangeSelector.PERIOD_PLACEHOLDER
+            )
+
+        # 開始日と終了日が逆転している場合は入れ替える
+        if start_date > end_date:
+            start_date, end_date = end_date, start_date
+
+        (
+            st.session_state.date_range_start,
+            st.session_state.date_range_end,
+        ) = DateRangeSelector._to_datetime_range(start_date, end_date)
+
     @staticmethod
     def render() -> Tuple[datetime, datetime]:
         """
@@ -93,30 +159,26 @@ class DateRangeSelector:
         """
 
         # 現在の日本時間を取得
-        now = datetime.now(ZoneInfo("Asia/Tokyo"))
+        now = datetime.now(JST)
 
         # セッションステートのキーを定義
         if "date_range_start" not in st.session_state:
             # デフォルトで1週間を表示
-            st.session_state.date_range_start = now - timedelta(days=7)
-            st.session_state.date_range_end = now
-
-        # カスタム入力期間
-        col1, col2 = st.columns(2)
-
-        with col1:
-            start_date = st.date_input(
-                "表示開始日",
-                value=st.session_state.date_range_start.date(),
-                max_value=now.date(),
+            start_date = (now - timedelta(days=7)).date()
+            (
+                st.session_state.date_range_start,
+                st.session_state.date_range_end,
+            ) = DateRangeSelector._to_datetime_range(start_date, now.date())
+
+        # ウィジェットのキーは描画されない実行 (ログイン画面など) で
+        # 削除されるため、欠けている場合は表示中の期間から入れ直す
+        if "date_range_start_input" not in st.session_state:
+            st.session_state.date_range_start_input = (
+                st.session_state.date_range_start.date()
             )
-
-        with col2:
-            end_date = st.date_input(
-                "表示終了日",
-                value=st.session_state.date_range_end.date(),
-                min_value=start_date,
-                max_value=now.date(),
+        if "date_range_end_input" not in st.session_state:
+            st.session_state.date_range_end_input = (
+                st.session_state.date_range_end.date()
             )
 
         # ラベルを非表示にするCSS
@@ -131,41 +193,41 @@ class DateRangeSelector:
             unsafe_allow_html=True,
         )
 
-        # クイック選択のドロップダウン
-        period_labels = [label for label, _ in DateRangeSelector.QUICK_PERIODS]
+        with st.form("date_range_form"):
+            # カスタム入力期間
+            col1, col2 = st.columns(2)
 
-        # "選択してください"をデフォルトとして追加
-        period_labels.insert(0, "ドロップダウンから表示期間の指定も可")
-
-        selected_period = st.selectbox(
-            "", options=period_labels, index=0
-        )  # ラベルはCSSで非表示になる
+            with col1:
+                st.date_input(
+                    "表示開始日",
+                    max_value=now.date(),
+                    key="date_range_start_input",
+                )
 
-        # 期間が選択された場合に日付を更新
-        if selected_period != "期間を選択してください":
-            # 選択された期間に一致する日数を見つける
-            for label, days in DateRangeSelector.QUICK_PERIODS:
-                if label == selected_period:
-                    st.session_state.date_range_start = now - timedelta(
-                        days=days
-                    )
-                    st.session_state.date_range_end = now
-                    st.rerun()
+            with col2:
+                st.date_input(
+                    "表示終了日",
+                    max_value=now.date(),
+                    key="date_range_end_input",
+                )
 
-        # datetime型に変換し、日本時間のタイムゾーン情報を追加
-        start_datetime = datetime.combine(
-            start_date, datetime.min.time()
-        ).replace(tzinfo=ZoneInfo("Asia/Tokyo"))
-        end_datetime = datetime.combine(end_date, datetime.max.time()).replace(
-            tzinfo=ZoneInfo("Asia/Tokyo")
+            # クイック選択のドロップダウン
+            period_labels = [
+                DateRangeSelector.PERIOD_PLACEHOLDER,
+                *(label for label, _ in DateRangeSelector.QUICK_PERIODS),
+            ]
+            st.selectbox(
+                "", options=period_labels, key="date_range_period"
+            )  # ラベルはCSSで非表示になる
+
+            # 適用ボタンが押されたときのみ表示期間を更新
+            st.form_submit_button("適用", on_click=DateRangeSelector._apply)
+
+        return (
+            st.session_state.date_range_start,
+            st.session_state.date_range_end,
         )
 
-        # セッションステートを更新
-        st.session_state.date_range_start = start_datetime
-        st.session_state.date_range_end = end_datetime
-
-        return start_datetime, end_datetime
-
 
 class WeightRecordEditor:
     """
@@ -176,10 +238,12 @@ class WeightRecordEditor:
     db : WeightDatabase
         データベース操作インスタンス
     records : List[WeightRecord]
-        表示する記録のリスト
+        日時順に並んだ表示する記録
     """
 
-    def __init__(self, db: WeightDatabase, records: list):
+    PAGE_SIZE = 20  # 1ページに表示する記録数
+
+    def __init__(self, db: WeightDatabase, records: List[WeightRecord]):
         self.db = db
         self.records = records
 
@@ -189,55 +253,118 @@ class WeightRecordEditor:
         """
         st.subheader("記録の編集・削除")
 
-        for i, record in enumerate(self.records):
-            with st.expander(
-                f"記録 {record.timestamp.strftime('%Y-%m-%d %H:%M')}"
-                f"({record.weight}kg, 食後{WeightRecord.get_time_after_meal_display(record.time_after_meal)})"
-            ):
-
-                # 編集フォーム
-                with st.form(f"edit_form_{i}"):
-                    new_date = st.date_input(
-                        "日付", value=record.timestamp.date()
-                    )
-
-                    new_weight = st.number_input(
-                        "体重 (kg)",
-                        value=record.weight,
-                        min_value=0.0,
-                        max_value=100.0,
-                        step=0.1,
-                        format="%.1f",
-                    )
-
-                    new_time = st.selectbox(
-                        "食後経過時間",
-                        options=[
-                            t[0] for t in WeightRecord.TIME_AFTER_MEAL_OPTIONS
-                        ],
-                        index=[
-                            t[0] for t in WeightRecord.TIME_AFTER_MEAL_OPTIONS
-                        ].index(record.time_after_meal),
-                        format_func=lambda x: dict(
-                            WeightRecord.TIME_AFTER_MEAL_OPTIONS
-                        )[x],
-                    )
-
-                    col1, col2 = st.columns(2)
-
-                    with col1:
-                        if st.form_submit_button("更新"):
-                            timestamp = datetime.combine(
-                                new_date, datetime.min.time()
-                            )
-                            if self.db.update_record(
-                                record.id, new_weight, new_time, timestamp
-                            ):
-                                st.success("記録を更新しました")
-                                st.rerun()
-
-                    with col2:
-                        if st.form_submit_button("削除", type="primary"):
-                            if self.db.delete_record(record.id):
-                                st.success("記録を削除しました")
-                                st.rerun()
+        # ページ番号をセッションステートで管理し、表示件数を制限する
+        page_size = WeightRecordEditor.PAGE_SIZE
+        last_page = max((len(self.records) - 1) // page_size, 0)
+        if "editor_page" not in st.session_state:
+            st.session_state.editor_page = 0
+        page = min(st.session_state.editor_page, last_page)
+        st.session_state.editor_page = page
+
+        offset = page * page_size
+        for record in self.records[offset : offset + page_size]:
+            self._render_record(record)
+
+        # ページ送り
+        if last_page > 0:
+            col1, col2, col3 = st.columns(3)
+
+            # ページ番号はコールバックで更新し、クリックによる再実行で
+            # そのまま新しいページを表示する
+            with col1:
+                st.button(
+                    "前へ",
+                    key="editor_prev",
+                    disabled=page == 0,
+                    on_click=WeightRecordEditor._set_page,
+                    args=(page - 1,),
+                )
+
+            with col2:
+                st.write(f"{page + 1} / {last_page + 1} ページ")
+
+            with col3:
+                st.button(
+                    "次へ",
+                    key="editor_next",
+                    disabled=page == last_page,
+                    on_click=WeightRecordEditor._set_page,
+                    args=(page + 1,),
+                )
+
+    @staticmethod
+    def _set_page(page: int):
+        """
+        「前へ」「次へ」ボタン押下時に表示するページを切り替える
+
+        Parameters
+        ----------
+        page : int
+            表示するページ番号 (0始まり)
+        """
+        st.session_state.editor_page = page
+
+    @st.fragment
+    def _render_record(self, record: WeightRecord):
+        """
+        1件分の記録編集フォームを描画
+
+        フラグメントとして描画するため、フォーム内の操作では
+        このフォームのみが再実行される (更新・削除の成功後はグラフと
+        一覧に反映するためアプリ全体を再実行する)。
+        編集フォームは「編集」ボタンが押されるまで生成しない
+
+        Parameters
+        ----------
+        record : WeightRecord
+            編集対象の記録
+        """
+        open_key = f"exp_open_{record.id}"
+        is_open = st.session_state.get(open_key, False)
+
+        with st.expander(record.label, expanded=is_open):
+            # 折りたたみ中の記録はボタン1つだけを生成する
+            if not is_open:
+                if not st.button("編集", key=f"open_{record.id}"):
+                    return
+                st.session_state[open_key] = True
+
+            # 編集フォーム
+            with st.form(f"edit_form_{record.id}"):
+                new_date = st.date_input("日付", value=record.timestamp.date())
+
+                new_weight = st.number_input(
+                    "体重 (kg)",
+                    value=record.weight,
+                    min_value=0.0,
+                    max_value=100.0,
+                    step=0.1,
+                    format="%.1f",
+                )
+
+                new_time = st.radio(
+                    "食後経過時間",
+                    options=_TIME_AFTER_MEAL_KEYS,
+                    index=_TIME_AFTER_MEAL_INDEX[record.time_after_meal],
+                    format_func=_TIME_AFTER_MEAL_MAP.__getitem__,
+                    horizontal=True,
+                )
+
+                col1, col2 = st.columns(2)
+
+                with col1:
+                    if st.form_submit_button("更新"):
+                        timestamp = datetime.combine(
+                            new_date, datetime.min.time()
+                        )
+                        if self.db.update_record(
+                            record.id, new_weight, new_time, timestamp
+                        ):
+                            st.success("記録を更新しました")
+                            st.rerun()
+
+                with col2:
+                    if st.form_submit_button("削除", type="primary"):
+                        if self.db.delete_record(record.id):
+                            st.success("記録を削除しました")
+                            st.rerun()
@@ -1,12 +1,63 @@
-import json
+import secrets
+import time
 from datetime import datetime
-from typing import List, Literal, Optional
+from operator import attrgetter
+from typing import Any, Dict, Iterator, List, Literal, Optional
 
+import orjson
 import streamlit as st
 from firebase_admin import db
 
 from models import WeightRecord
 
+# FirebaseのプッシュIDで使用される文字 (ASCII順)
+_PUSH_CHARS = (
+    "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+)
+
+
+def _generate_push_id() -> str:
+    """
+    Firebaseのpush()と同形式のレコードIDをローカルで生成する
+
+    先頭8文字がミリ秒単位の時刻を表すため、IDの辞書順は作成順と一致する
+
+    Returns
+    -------
+    str
+        20文字のレコードID
+    """
+    now_ms = int(time.time() * 1000)
+    time_chars = []
+    for _ in range(8):
+        time_chars.append(_PUSH_CHARS[now_ms % 64])
+        now_ms //= 64
+    random_chars = [secrets.choice(_PUSH_CHARS) for _ in range(12)]
+    return "".join(reversed(time_chars)) + "".join(random_chars)
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _fetch_all(user_type: str, version: int) -> dict:
+    """
+    ユーザーの全体重データをFirebaseから取得する
+
+    データバージョンをキャッシュキーに含めるため、書き込みがない限り
+    Firebaseへの再取得は発生しない
+
+    Parameters
+    ----------
+    user_type : str
+        ユーザータイプ
+    version : int
+        データバージョン (weights_meta/{user_type}/version)
+
+    Returns
+    -------
+    dict
+        レコードIDをキーとする体重データの辞書
+    """
+    return db.reference(f"weights/{user_type}").get() or {}
+
 
 class WeightDatabase:
     """
@@ -18,6 +69,8 @@ class WeightDatabase:
         ユーザータイプ (secrets["app"]["user_type"])
     """
 
+    EXPORT_PAGE_SIZE = 500  # エクスポート時に1回で取得する記録数
+
     def __init__(self, user_type: str):
         """
         Parameters
@@ -27,6 +80,36 @@ class WeightDatabase:
         """
         self.user_type = user_type
         self.ref = db.reference(f"weights/{user_type}")
+        self.version_ref = db.reference(f"weights_meta/{user_type}/version")
+
+    def _get_version(self) -> int:
+        """
+        データバージョンを取得
+
+        Returns
+        -------
+        int
+            書き込みごとに増加するデータバージョン
+        """
+        return self.version_ref.get() or 0
+
+    def _update_with_version(self, changes: Dict[str, Any]):
+        """
+        体重データの変更とデータバージョンの更新を1回の通信で反映する
+
+        Parameters
+        ----------
+        changes : Dict[str, Any]
+            weights/{user_type}からの相対パスをキーとする変更内容
+        """
+        updates = {
+            f"weights/{self.user_type}/{path}": value
+            for path, value in changes.items()
+        }
+        updates[f"weights_meta/{self.user_type}/version"] = {
+            ".sv": {"increment": 1}
+        }
+        db.reference().update(updates)
 
     def add_record(
         self, weight: float, time_after_meal: float, timestamp: datetime
@@ -54,7 +137,7 @@ class WeightDatabase:
                 timestamp=timestamp,
                 time_after_meal=time_after_meal,
             )
-            self.ref.push().set(record.to_dict())
+            self._update_with_version({_generate_push_id(): record.to_dict()})
             return True
         except Exception as e:
             st.error(f"データ追加エラー: {str(e)}")
@@ -81,21 +164,22 @@ class WeightDatabase:
             体重記録のリスト
         """
         try:
-            records = self.ref.get() or {}
-            result = []
-
-            for record_id, data in records.items():
-                record = WeightRecord.from_dict(data)
-                record.id = record_id  # レコードIDを設定
+            records = _fetch_all(self.user_type, self._get_version())
+            result = WeightRecord.from_list(
+                list(records.values()), list(records)
+            )
 
-                # 期間指定がある場合のみフィルタリング
-                if start_date and end_date:
-                    if start_date <= record.timestamp <= end_date:
-                        result.append(record)
-                else:
-                    result.append(record)
+            # 期間指定がある場合のみフィルタリング
+            if start_date and end_date:
+                result = [
+                    record
+                    for record in result
+                    if start_date <= record.timestamp <= end_date
+                ]
 
-            return sorted(result, key=lambda x: x.timestamp)
+            # 過去日付での記録があり得るため日時順に並べ替える
+            result.sort(key=attrgetter("timestamp"))
+            return result
         except Exception as e:
             st.error(f"データ取得エラー: {str(e)}")
             return []
@@ -127,14 +211,19 @@ class WeightDatabase:
             更新成功でTrue、失敗でFalse
         """
         try:
-            record_ref = self.ref.child(record_id)
             record = WeightRecord(
                 weight=weight,
                 timestamp=timestamp,
                 time_after_meal=time_after_meal,
                 edited=True,
             )
-            record_ref.set(record.to_dict())
+            # 記録全体を上書きせず、各フィールドのみを更新する
+            self._update_with_version(
+                {
+                    f"{record_id}/{field}": value
+                    for field, value in record.to_dict().items()
+                }
+            )
             return True
         except Exception as e:
             st.error(f"データ更新エラー: {str(e)}")
@@ -155,13 +244,53 @@ class WeightDatabase:
             削除成功でTrue、失敗でFalse
         """
         try:
-            self.ref.child(record_id).delete()
+            # 削除とデータバージョンの更新を1回の通信でまとめて反映する
+            self._update_with_version({record_id: None})
             return True
         except Exception as e:
             st.error(f"データ削除エラー: {str(e)}")
             return False
 
-    def export_data(self, export_path: Optional[str] = None) -> str:
+    def _iter_pages(self, page_size: int) -> Iterator[Dict[str, dict]]:
+        """
+        ユーザーの体重データをレコードID順にページ単位で取得
+
+        Parameters
+        ----------
+        page_size : int
+            1ページあたりの記録数
+
+        Yields
+        ------
+        Dict[str, dict]
+            レコードIDをキーとする1ページ分の体重データ
+        """
+        last_key = None
+        while True:
+            query = self.ref.order_by_key()
+            if last_key is None:
+                page = query.limit_to_first(page_size).get() or {}
+            else:
+                # start_atは境界を含むため1件多く取得して先頭を除く
+                page = (
+                    query.start_at(last_key)
+                    .limit_to_first(page_size + 1)
+                    .get()
+                    or {}
+                )
+                page.pop(last_key, None)
+
+            if not page:
+                return
+            yield page
+
+            last_key = next(reversed(page))
+            if len(page) < page_size:
+                return
+
+    def export_data(
+        self, export_path: Optional[str] = None, pretty: bool = False
+    ) -> str:
         """
         ユーザーの体重データをJSONファイルとしてエクスポート
 
@@ -169,6 +298,8 @@ class WeightDatabase:
         ----------
         export_path : Optional[str], default None
             エクスポート先のパス, Noneの場合は現在の日時でファイル名を生成
+        pretty : bool, default False
+            インデント付きの読みやすい形式で出力する場合True
 
         Returns
         -------
@@ -176,11 +307,6 @@ class WeightDatabase:
             エクスポートされたファイルのパス
         """
         try:
-            # データの取得
-            data = self.ref.get()
-            if data is None:
-                st.error(f"ユーザー {self.user_type} のデータが見つかりません")
-
             # エクスポートパスの設定
             if export_path is None:
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -188,9 +314,30 @@ class WeightDatabase:
                     f"weight_tracker_{self.user_type}_{timestamp}.json"
                 )
 
-            # JSONとしてエクスポート
-            with open(export_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            # JSONとしてエクスポート (既定はバックアップ向けのコンパクト形式)
+            # ページ単位で取得・書き込みし、全データをメモリに載せない
+            if pretty:
+                item_sep, key_sep = b",\n  ", b": "
+                option = orjson.OPT_INDENT_2
+            else:
+                item_sep, key_sep = b",", b":"
+                option = None
+
+            count = 0
+            with open(export_path, "wb") as f:
+                f.write(b"{")
+                for page in self._iter_pages(self.EXPORT_PAGE_SIZE):
+                    for record_id, data in page.items():
+                        value = orjson.dumps(data, option=option)
+                        if pretty:
+                            value = value.replace(b"\n", b"\n  ")
+                        f.write(item_sep if count else item_sep.lstrip(b","))
+                        f.write(orjson.dumps(record_id) + key_sep + value)
+                        count += 1
+                f.write(b"\n}" if pretty and count else b"}")
+
+            if count == 0:
+                st.error(f"ユーザー {self.user_type} のデータが見つかりません")
 
             return export_path
 
@@ -1,10 +1,11 @@
 import hashlib
+import hmac
 import os
-import time
 import uuid
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
-from typing import Any, Dict, Optional
-from zoneinfo import ZoneInfo
+from operator import attrgetter
+from typing import Any, Dict, List, Optional
 
 import firebase_admin
 import streamlit as st
@@ -12,10 +13,19 @@ from firebase_admin import credentials, db
 
 from components import DateRangeSelector, WeightInputForm, WeightRecordEditor
 from database import WeightDatabase
+from models import JST, USER_TYPES, WeightRecord
+from utils import run_parallel
 from visualization import WeightVisualizer
 
-# Firebaseの初期化
-if not firebase_admin._apps:
+
+@st.cache_resource
+def init_firebase():
+    """
+    Firebaseを初期化する (プロセスごとに1回のみ実行)
+    """
+    if firebase_admin._apps:
+        return
+
     # Streamlit Cloudのsecretsから認証情報を取得
     cred_dict = {
         "type": st.secrets["firebase"]["type"],
@@ -38,7 +48,54 @@ if not firebase_admin._apps:
     )
 
 
-def hash_password(password: str, salt: str = "") -> str:
+@st.cache_resource
+def get_db(user_type: str) -> WeightDatabase:
+    """
+    ユーザーごとのデータベース操作インスタンスを取得する
+
+    Parameters
+    ----------
+    user_type : str
+        ユーザータイプ
+
+    Returns
+    -------
+    WeightDatabase
+        再実行をまたいで共有されるデータベース操作インスタンス
+    """
+    return WeightDatabase(user_type)
+
+
+def fetch_records_parallel(
+    databases: List[WeightDatabase],
+) -> List[List[WeightRecord]]:
+    """
+    複数ユーザーの全体重記録を並列に取得する
+
+    Parameters
+    ----------
+    databases : List[WeightDatabase]
+        取得対象のデータベース操作インスタンス
+
+    Returns
+    -------
+    List[List[WeightRecord]]
+        databasesと同じ順序の体重記録リスト
+    """
+    # 期間指定なしで全データを取得
+    return run_parallel(lambda database: database.get_records(), databases)
+
+
+# パスワードハッシュのパラメータ (ユーザー情報にも保存し、将来の移行に備える)
+DEFAULT_KDF = {"algo": "scrypt", "n": 2**14, "r": 8, "p": 1}
+
+# KDF導入前に登録されたユーザーのパラメータ
+LEGACY_KDF = {"algo": "sha256"}
+
+
+def hash_password(
+    password: str, salt: str = "", kdf: Optional[Dict[str, Any]] = None
+) -> str:
     """
     パスワードをハッシュ化する
 
@@ -48,18 +105,37 @@ def hash_password(password: str, salt: str = "") -> str:
         ハッシュ化するパスワード
     salt : str, optional
         ソルト文字列, by default ""
+    kdf : Optional[Dict[str, Any]], optional
+        ハッシュ関数とそのパラメータ, by default None (DEFAULT_KDF)
 
     Returns
     -------
     str
         ハッシュ化されたパスワード
     """
-    return hashlib.sha256((password + salt).encode()).hexdigest()
-
-
+    if kdf is None:
+        kdf = DEFAULT_KDF
+
+    if kdf["algo"] == "sha256":
+        # 文字列を連結せずに順に入力する (連結後のハッシュと同じ値になる)
+        h = hashlib.sha256(password.encode())
+        h.update(salt.encode())
+        return h.hexdigest()
+
+    return hashlib.scrypt(
+        password.encode(),
+        salt=salt.encode(),
+        n=kdf["n"],
+        r=kdf["r"],
+        p=kdf["p"],
+        dklen=32,
+    ).hex()
+
+
+@st.cache_data(ttl=30, show_spinner=False)
 def verify_user(user_id: str) -> Optional[Dict[str, Any]]:
     """
-    ユーザーIDが登録済みか確認する
+    ユーザーIDが登録済みか確認する (30秒キャッシュ)
 
     Parameters
     ----------
@@ -71,9 +147,7 @@ def verify_user(user_id: str) -> Optional[Dict[str, Any]]:
     Optional[Dict[str, Any]]
         登録済みの場合はユーザー情報、未登録の場合はNone
     """
-    ref = db.reference("users")
-    devices = ref.get() or {}
-    return devices.get(user_id)
+    return db.reference(f"users/{user_id}").get()
 
 
 def register_user(user_id: str, password: str) -> bool:
@@ -94,27 +168,29 @@ def register_user(user_id: str, password: str) -> bool:
     """
     try:
         # secrets.tomlに定義されているユーザーIDかチェック
-        if user_id not in st.secrets["app"]["user_type"]:
+        if user_id not in USER_TYPES:
             st.error("無効なユーザーIDです")
             return False
 
-        ref = db.reference("users")
-        users = ref.get() or {}
-
-        # すでに同じユーザーIDが登録されていないか確認
-        if user_id in users:
-            st.error("このユーザーIDはすでに登録されています")
-            return False
-
         # ソルトを生成
         salt = uuid.uuid4().hex
 
-        users[user_id] = {
+        new_user = {
             "password": hash_password(password, salt),
             "salt": salt,
-            "registered_at": datetime.now(ZoneInfo("Asia/Tokyo")).isoformat(),
+            "kdf": DEFAULT_KDF,
+            "registered_at": datetime.now(JST).isoformat(),
         }
-        ref.set(users)
+
+        # 未登録の場合のみ書き込む (同時登録でも上書きしないようトランザクションで実行)
+        result = db.reference(f"users/{user_id}").transaction(
+            lambda current: new_user if current is None else current
+        )
+        if result.get("salt") != salt:
+            st.error("このユーザーIDはすでに登録されています")
+            return False
+
+        verify_user.clear()
         return True
     except Exception as e:
         st.error(f"ユーザー登録エラー: {str(e)}")
@@ -137,13 +213,33 @@ def authenticate(user_id: str, password: str) -> bool:
     bool
         認証成功の場合True、失敗の場合False
     """
+    # ロック中はハッシュ計算を行わずに失敗とする
+    if is_account_locked(user_id):
+        return False
+
     user_info = verify_user(user_id)
-    if user_info and user_info["password"] == hash_password(
-        password, user_info["salt"]
+    if not user_info:
+        return False
+
+    kdf = user_info.get("kdf", LEGACY_KDF)
+    # タイミング攻撃を避けるため定数時間で比較する
+    if not hmac.compare_digest(
+        user_info["password"], hash_password(password, user_info["salt"], kdf)
     ):
-        st.session_state["user_type"] = user_id
-        return True
-    return False
+        return False
+
+    # 旧方式 (SHA-256) のハッシュはログイン成功時にKDFで再ハッシュする
+    if kdf != DEFAULT_KDF:
+        db.reference(f"users/{user_id}").update(
+            {
+                "password": hash_password(password, user_info["salt"]),
+                "kdf": DEFAULT_KDF,
+            }
+        )
+        verify_user.clear()
+
+    st.session_state["user_type"] = user_id
+    return True
 
 
 def login_page():
@@ -162,7 +258,7 @@ def login_page():
     # ユーザーIDはsecrets.tomlで定義されたのものから選択
     user_id = st.selectbox(
         "ユーザーID",
-        st.secrets["app"]["user_type"],
+        USER_TYPES,
     )
 
     # エラーメッセージの表示
@@ -199,7 +295,7 @@ def login_page():
                 st.rerun()
             else:
                 increment_login_attempts(user_id)  # 失敗時はカウントを増やす
-                attempts = st.session_state["login_attempts"][user_id]
+                attempts = _load_attempts(user_id)
 
                 if attempts["locked_until"]:
                     # ロックされた場合
@@ -239,13 +335,60 @@ def init_session_state():
         st.session_state["last_activity"] = None
     if "show_timeout_warning" not in st.session_state:
         st.session_state["show_timeout_warning"] = False
-    if "login_attempts" not in st.session_state:
-        st.session_state["login_attempts"] = {}
     if "login_error" not in st.session_state:
         st.session_state["login_error"] = None
 
 
-def is_account_locked(user_id: str) -> bool:
+@st.cache_data(ttl=5, show_spinner=False)
+def _load_attempts(user_id: str) -> Dict[str, Any]:
+    """
+    ログイン試行状況をFirebaseから取得する (5秒キャッシュ)
+
+    セッションをまたいで共有するため、ブラウザを変えても
+    試行回数やロック状態はリセットされない
+
+    Parameters
+    ----------
+    user_id : str
+        ユーザーID
+
+    Returns
+    -------
+    Dict[str, Any]
+        試行回数 (count) とロック解除時刻 (locked_until)
+    """
+    data = db.reference(f"login_attempts/{user_id}").get() or {}
+    locked_until = data.get("locked_until")
+    return {
+        "count": data.get("count", 0),
+        "locked_until": (
+            datetime.fromisoformat(locked_until) if locked_until else None
+        ),
+    }
+
+
+def _save_attempts(user_id: str, attempts: Dict[str, Any]):
+    """
+    ログイン試行状況をFirebaseに保存する
+
+    Parameters
+    ----------
+    user_id : str
+        ユーザーID
+    attempts : Dict[str, Any]
+        試行回数 (count) とロック解除時刻 (locked_until)
+    """
+    locked_until = attempts["locked_until"]
+    db.reference(f"login_attempts/{user_id}").set(
+        {
+            "count": attempts["count"],
+            "locked_until": locked_until.isoformat() if locked_until else None,
+        }
+    )
+    _load_attempts.clear()
+
+
+def is_account_locked(user_id: str, now: Optional[datetime] = None) -> bool:
     """
     アカウントがロック中かどうかを確認する
 
@@ -253,22 +396,26 @@ def is_account_locked(user_id: str) -> bool:
     ----------
     user_id : str
         ユーザーID
+    now : Optional[datetime], optional
+        判定に使う現在時刻 (日本時間), by default None (現在時刻を取得)
 
     Returns
     -------
     bool
         ロック中の場合True
     """
-    attempts = st.session_state["login_attempts"].get(
-        user_id, {"count": 0, "locked_until": None}
-    )
+    attempts = _load_attempts(user_id)
+    if now is None:
+        now = datetime.now(JST)
     if attempts["locked_until"]:
-        if datetime.now() < attempts["locked_until"]:
+        if now < attempts["locked_until"]:
             return True
     return False
 
 
-def get_remaining_lock_time(user_id: str) -> int:
+def get_remaining_lock_time(
+    user_id: str, now: Optional[datetime] = None
+) -> int:
     """
     ロック解除までの残り時間 (分) を取得する
 
@@ -276,23 +423,23 @@ def get_remaining_lock_time(user_id: str) -> int:
     ----------
     user_id : str
         ユーザーID
+    now : Optional[datetime], optional
+        判定に使う現在時刻 (日本時間), by default None (現在時刻を取得)
 
     Returns
     -------
     int
         残り時間 (分) 。ロックされていない場合は0
     """
-    attempts = st.session_state["login_attempts"].get(
-        user_id, {"count": 0, "locked_until": None}
-    )
-    if attempts["locked_until"] and datetime.now() < attempts["locked_until"]:
-        return int(
-            (attempts["locked_until"] - datetime.now()).total_seconds() / 60
-        )
+    attempts = _load_attempts(user_id)
+    if now is None:
+        now = datetime.now(JST)
+    if attempts["locked_until"] and now < attempts["locked_until"]:
+        return int((attempts["locked_until"] - now).total_seconds() / 60)
     return 0
 
 
-def check_login_attempts(user_id: str) -> bool:
+def check_login_attempts(user_id: str, now: Optional[datetime] = None) -> bool:
     """
     ログイン試行回数をチェックする
 
@@ -300,6 +447,8 @@ def check_login_attempts(user_id: str) -> bool:
     ----------
     user_id : str
         チェックするユーザーID
+    now : Optional[datetime], optional
+        判定に使う現在時刻 (日本時間), by default None (現在時刻を取得)
 
     Returns
     -------
@@ -308,21 +457,17 @@ def check_login_attempts(user_id: str) -> bool:
     """
     MAX_ATTEMPTS = 3
 
-    attempts = st.session_state["login_attempts"].get(
-        user_id, {"count": 0, "locked_until": None}
-    )
-    current_time = datetime.now()
+    attempts = _load_attempts(user_id)
+    if now is None:
+        now = datetime.now(JST)
 
     # ロック時間のチェック
     if attempts["locked_until"]:
-        if current_time < attempts["locked_until"]:
+        if now < attempts["locked_until"]:
             return False
         else:
             # ロック時間が経過したらリセット
-            st.session_state["login_attempts"][user_id] = {
-                "count": 0,
-                "locked_until": None,
-            }
+            reset_login_attempts(user_id)
             st.session_state["login_error"] = None
             return True
 
@@ -341,21 +486,27 @@ def increment_login_attempts(user_id: str):
     MAX_ATTEMPTS = 3
     LOCK_TIME_MINUTES = 15
 
-    attempts = st.session_state["login_attempts"].get(
-        user_id, {"count": 0, "locked_until": None}
-    )
-    attempts["count"] += 1
-
-    if attempts["count"] >= MAX_ATTEMPTS:
-        attempts["locked_until"] = datetime.now(
-            ZoneInfo("Asia/Tokyo")
-        ) + timedelta(minutes=LOCK_TIME_MINUTES)
-        st.error(
-            f"ログイン試行回数が上限を超えました。{LOCK_TIME_MINUTES}分間ロックされます。"
-        )
-        time.sleep(5)
+    now = datetime.now(JST)
+
+    def increment(current: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        current = current or {}
+        count = current.get("count", 0)
+        locked_until = current.get("locked_until")
+
+        # ロック時間が経過している場合はリセットしてから数える
+        if locked_until and datetime.fromisoformat(locked_until) <= now:
+            count, locked_until = 0, None
 
-    st.session_state["login_attempts"][user_id] = attempts
+        count += 1
+        if count >= MAX_ATTEMPTS:
+            locked_until = (
+                now + timedelta(minutes=LOCK_TIME_MINUTES)
+            ).isoformat()
+        return {"count": count, "locked_until": locked_until}
+
+    # 同時に失敗したログインの回数を取りこぼさないようトランザクションで更新
+    db.reference(f"login_attempts/{user_id}").transaction(increment)
+    _load_attempts.clear()
 
 
 def reset_login_attempts(user_id: str):
@@ -367,16 +518,18 @@ def reset_login_attempts(user_id: str):
     user_id : str
         ユーザーID
     """
-    st.session_state["login_attempts"][user_id] = {
-        "count": 0,
-        "locked_until": None,
-    }
+    _save_attempts(user_id, {"count": 0, "locked_until": None})
 
 
-def check_session_timeout():
+def check_session_timeout(now: datetime):
     """
     セッションタイムアウトをチェックする
     30分以上操作がない場合、自動的にログアウトする
+
+    Parameters
+    ----------
+    now : datetime
+        今回の実行で共通して使う現在時刻 (日本時間)
     """
     TIMEOUT_MINUTES = 30
 
@@ -384,15 +537,13 @@ def check_session_timeout():
     if not st.session_state["logged_in"]:
         return
 
-    current_time = datetime.now(ZoneInfo("Asia/Tokyo"))
-
     # 最終アクティビティ時刻の更新
     if st.session_state["last_activity"] is None:
-        st.session_state["last_activity"] = current_time
+        st.session_state["last_activity"] = now
 
     # タイムアウトチェック
     if st.session_state["last_activity"] is not None:
-        time_diff = current_time - st.session_state["last_activity"]
+        time_diff = now - st.session_state["last_activity"]
         if time_diff.total_seconds() > TIMEOUT_MINUTES * 60:
             # セッションタイムアウト時の処理
             st.session_state["logged_in"] = False
@@ -402,15 +553,50 @@ def check_session_timeout():
             st.rerun()
 
     # アクティビティ時刻の更新
-    st.session_state["last_activity"] = current_time
+    st.session_state["last_activity"] = now
+
+
+@st.fragment
+def render_graph(
+    records1: List[WeightRecord],
+    records2: List[WeightRecord],
+    start_date: datetime,
+    end_date: datetime,
+):
+    """
+    予測表示の切り替えとグラフを描画する
+
+    フラグメントとして描画するため、予測表示の切り替えでは
+    グラフのみが再実行され、Firebaseへの再取得は発生しない
+
+    Parameters
+    ----------
+    records1 : List[WeightRecord]
+        ユーザー1の記録リスト
+    records2 : List[WeightRecord]
+        ユーザー2の記録リスト
+    start_date : datetime
+        表示開始日
+    end_date : datetime
+        表示終了日
+    """
+    show_prediction = st.checkbox("予測表示", value=False)
+    visualizer = WeightVisualizer(
+        records1, records2, start_date, end_date, show_prediction
+    )
+    visualizer.render()
 
 
 def main():
     """
     メインアプリケーション
     """
+    # 今回の実行で使う現在時刻を一度だけ取得
+    now = datetime.now(JST)
+
+    init_firebase()
     init_session_state()
-    check_session_timeout()  # セッションタイムアウトのチェック
+    check_session_timeout(now)  # セッションタイムアウトのチェック
 
     if not st.session_state["logged_in"]:
         login_page()
@@ -421,73 +607,67 @@ def main():
 
     # セッションタイムアウトまでの残り時間を表示
     if st.session_state["last_activity"] is not None:
-        current_time = datetime.now(ZoneInfo("Asia/Tokyo"))
         remaining_time = (
-            30
-            - (
-                current_time - st.session_state["last_activity"]
-            ).total_seconds()
-            / 60
+            30 - (now - st.session_state["last_activity"]).total_seconds() / 60
         )
         if remaining_time > 0:
             st.sidebar.info(
                 f"セッションタイムアウトまで: {int(remaining_time)}分"
             )
 
-    # データベースインスタンスの作成
-    db = WeightDatabase(st.session_state["user_type"])
+    # データベースインスタンスの作成 (各ユーザー1つずつ)
+    db1 = get_db(USER_TYPES[0])
+    db2 = get_db(USER_TYPES[1])
+    current_db = db1 if st.session_state["user_type"] == USER_TYPES[0] else db2
 
     # サイドバーに入力フォームを配置
     with st.sidebar:
-        weight_form = WeightInputForm(db)
+        weight_form = WeightInputForm(current_db)
         weight_form.render()
 
-        # 予測表示の切り替え
-        show_prediction = st.checkbox("予測表示", value=False)
-
         # エクスポート機能
-        try:
-            file_path = db.export_data()
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = f.read()
-                st.download_button(
-                    label="データをエクスポート",
-                    data=data,
-                    file_name=os.path.basename(file_path),
-                    mime="application/json",
-                )
-            # 一時ファイルの削除
-            os.remove(file_path)
-        except Exception as e:
-            st.error(f"エクスポートに失敗しました: {str(e)}")
+        # (全データの取得は重いため、ボタンが押されたときのみ実行する)
+        if st.button("エクスポートを準備"):
+            try:
+                file_path = current_db.export_data()
+                with open(file_path, "rb") as f:
+                    st.session_state["export_file"] = (
+                        current_db.user_type,
+                        os.path.basename(file_path),
+                        f.read(),
+                    )
+                # 一時ファイルの削除
+                os.remove(file_path)
+            except Exception as e:
+                st.error(f"エクスポートに失敗しました: {str(e)}")
+
+        export_file = st.session_state.get("export_file")
+        if export_file and export_file[0] == current_db.user_type:
+            _, file_name, data = export_file
+            st.download_button(
+                label="データをエクスポート",
+                data=data,
+                file_name=file_name,
+                mime="application/json",
+            )
 
     # メイン画面に期間選択と記録表示
     start_date, end_date = DateRangeSelector.render()
 
     # 両ユーザーのデータを取得
-    db1 = WeightDatabase(st.secrets["app"]["user_type"][0])
-    db2 = WeightDatabase(st.secrets["app"]["user_type"][1])
-    records1 = db1.get_records()  # 期間指定なしで全データを取得
-    records2 = db2.get_records()
+    records1, records2 = fetch_records_parallel([db1, db2])
 
     # グラフの表示
-    visualizer = WeightVisualizer(
-        records1, records2, start_date, end_date, show_prediction
-    )
-    visualizer.render()
+    render_graph(records1, records2, start_date, end_date)
 
     # 現在のユーザーの記録のみ編集可能
-    current_db = WeightDatabase(st.session_state["user_type"])
-    current_records = [
-        r
-        for r in (
-            db1
-            if st.session_state["user_type"]
-            == st.secrets["app"]["user_type"][0]
-            else db2
-        ).get_records()
-        if start_date <= r.timestamp <= end_date
-    ]
+    # (取得済みの記録から表示期間を切り出すため、Firebaseへの問い合わせはない)
+    current_all = records1 if current_db is db1 else records2
+    # 記録は日時順に並んでいるため二分探索で範囲を求める
+    by_timestamp = attrgetter("timestamp")
+    lo = bisect_left(current_all, start_date, key=by_timestamp)
+    hi = bisect_right(current_all, end_date, key=by_timestamp)
+    current_records = current_all[lo:hi]
     editor = WeightRecordEditor(current_db, current_records)
     editor.render()
 
@@ -495,6 +675,7 @@ def main():
         st.session_state["logged_in"] = False
         st.session_state["user_type"] = None
         st.session_state["last_activity"] = None
+        st.session_state.pop("export_file", None)
         st.rerun()
 
 
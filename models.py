@@ -1,10 +1,20 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 from zoneinfo import ZoneInfo
 
+import numpy as np
+import pandas as pd
+import streamlit as st
 
-@dataclass
+# 日本時間のタイムゾーン
+JST = ZoneInfo("Asia/Tokyo")
+
+# secrets.tomlで定義されたユーザーID (アプリ実行中は不変)
+USER_TYPES = tuple(st.secrets["app"]["user_type"])
+
+
+@dataclass(slots=True)
 class WeightRecord:
     """
     体重記録のデータモデル
@@ -39,6 +49,9 @@ class WeightRecord:
     time_after_meal: float
     edited: bool = False
     id: Optional[str] = None
+    _label: Optional[str] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     # 食後経過時間の選択肢を定義
     TIME_AFTER_MEAL_OPTIONS = [
@@ -50,6 +63,7 @@ class WeightRecord:
         (3.0, "3時間"),
         (3.5, "3時間30分以上"),
     ]
+    _TIME_AFTER_MEAL_MAP = dict(TIME_AFTER_MEAL_OPTIONS)
 
     def to_dict(self) -> Dict[str, Any]:
         """
@@ -62,7 +76,7 @@ class WeightRecord:
         """
         # タイムゾーン情報がない場合は日本時間として扱う
         if self.timestamp.tzinfo is None:
-            timestamp = self.timestamp.replace(tzinfo=ZoneInfo("Asia/Tokyo"))
+            timestamp = self.timestamp.replace(tzinfo=JST)
         else:
             timestamp = self.timestamp
 
@@ -91,7 +105,7 @@ class WeightRecord:
         timestamp = datetime.fromisoformat(data["timestamp"])
         # タイムゾーン情報がない場合は日本時間として扱う
         if timestamp.tzinfo is None:
-            timestamp = timestamp.replace(tzinfo=ZoneInfo("Asia/Tokyo"))
+            timestamp = timestamp.replace(tzinfo=JST)
 
         return cls(
             weight=float(data["weight"]),
@@ -100,6 +114,101 @@ class WeightRecord:
             edited=data.get("edited", False),
         )
 
+    @staticmethod
+    def parse_timestamps(values: pd.Series) -> pd.Series:
+        """
+        ISO 8601形式の日時文字列をまとめて日本時間の日時に変換
+
+        Parameters
+        ----------
+        values : pd.Series
+            データベースから取得した日時文字列
+
+        Returns
+        -------
+        pd.Series
+            日本時間 (Asia/Tokyo) の日時
+        """
+        timestamps = pd.to_datetime(values, format="ISO8601", utc=True)
+        # タイムゾーン情報がない場合は日本時間として扱う (from_dictと同じ)
+        naive = ~values.str.contains(r"(?:Z|[+-]\d{2}:?\d{2})$")
+        if naive.any():
+            timestamps[naive] -= pd.Timedelta(hours=9)
+        return timestamps.dt.tz_convert(JST)
+
+    @classmethod
+    def from_list(
+        cls,
+        data_list: List[Dict[str, Any]],
+        ids: Optional[List[str]] = None,
+    ) -> List["WeightRecord"]:
+        """
+        辞書形式のデータのリストからWeightRecordのリストを生成
+
+        日時の文字列はpd.to_datetimeでまとめて変換する
+
+        Parameters
+        ----------
+        data_list : List[Dict[str, Any]]
+            データベースから取得した辞書データのリスト
+        ids : Optional[List[str]], optional
+            data_listと同じ順序のレコードID, by default None
+
+        Returns
+        -------
+        List[WeightRecord]
+            生成されたWeightRecordインスタンスのリスト
+        """
+        if not data_list:
+            return []
+
+        count = len(data_list)
+        weights = np.fromiter(
+            (d["weight"] for d in data_list), dtype=float, count=count
+        )
+        times_after_meal = np.fromiter(
+            (d["time_after_meal"] for d in data_list),
+            dtype=float,
+            count=count,
+        )
+
+        timestamps = cls.parse_timestamps(
+            pd.Series([d["timestamp"] for d in data_list])
+        ).dt.to_pydatetime()
+
+        if ids is None:
+            ids = [None] * count
+        return [
+            cls(
+                weight=float(weight),
+                timestamp=timestamp,
+                time_after_meal=float(time_after_meal),
+                edited=data.get("edited", False),
+                id=record_id,
+            )
+            for weight, timestamp, time_after_meal, data, record_id in zip(
+                weights, timestamps, times_after_meal, data_list, ids
+            )
+        ]
+
+    @property
+    def label(self) -> str:
+        """
+        記録一覧に表示するラベル文字列 (初回アクセス時に生成して保持)
+
+        Returns
+        -------
+        str
+            日時・体重・食後経過時間を含む表示用文字列
+        """
+        if self._label is None:
+            self._label = (
+                f"記録 {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
+                f"({self.weight}kg, "
+                f"食後{self.get_time_after_meal_display(self.time_after_meal)})"
+            )
+        return self._label
+
     @classmethod
     def get_time_after_meal_display(cls, value: float) -> str:
         """
@@ -115,7 +224,4 @@ class WeightRecord:
         str
             表示用文字列
         """
-        for time_value, display_text in cls.TIME_AFTER_MEAL_OPTIONS:
-            if time_value == value:
-                return display_text
-        return "不明"
+        return cls._TIME_AFTER_MEAL_MAP.get(value, "不明")
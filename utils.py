@@ -0,0 +1,44 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, TypeVar
+
+from streamlit.runtime.scriptrunner import (
+    add_script_run_ctx,
+    get_script_run_ctx,
+)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def run_parallel(func: Callable[[T], R], items: Iterable[T]) -> List[R]:
+    """
+    要素ごとの処理をスレッドプールで並列に実行する
+
+    ワーカースレッドにも実行中のスクリプトのコンテキストを引き継ぐため、
+    func内からst.cache_dataやst.errorを使用できる
+
+    Parameters
+    ----------
+    func : Callable[[T], R]
+        各要素に適用する関数
+    items : Iterable[T]
+        処理対象の要素
+
+    Returns
+    -------
+    List[R]
+        itemsと同じ順序の処理結果
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    ctx = get_script_run_ctx()
+
+    def run(item: T) -> R:
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(item)
+
+    with ThreadPoolExecutor(max_workers=len(items)) as executor:
+        return list(executor.map(run, items))
@@ -1,14 +1,96 @@
-from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import plotly.graph_objects as go
 import streamlit as st
 from plotly.subplots import make_subplots
-from sklearn.ensemble import GradientBoostingRegressor
-from sklearn.preprocessing import StandardScaler
 
-from models import WeightRecord
+from models import JST, USER_TYPES, WeightRecord
+from utils import run_parallel
+
+
+def _records_to_columns(records: List[WeightRecord]) -> Dict[str, np.ndarray]:
+    """
+    体重記録リストを列ごとのNumPy配列に変換する
+
+    Parameters
+    ----------
+    records : List[WeightRecord]
+        日時順に並んだ体重記録リスト
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        以下のキーを持つ配列の辞書
+
+        - ts: 記録日時 (エポック秒)
+        - dates: 記録日時 (グラフ表示用の現地時刻, datetime64[s])
+        - weight: 体重
+        - tam: 食後経過時間
+        - hour: 記録時刻 (時)
+        - weekday: 曜日
+    """
+    n = len(records)
+    return {
+        "ts": np.fromiter(
+            (r.timestamp.timestamp() for r in records), np.float64, count=n
+        ),
+        "dates": np.array(
+            [r.timestamp.replace(tzinfo=None) for r in records],
+            dtype="datetime64[s]",
+        ),
+        "weight": np.fromiter(
+            (r.weight for r in records), np.float64, count=n
+        ),
+        "tam": np.fromiter(
+            (r.time_after_meal for r in records), np.float64, count=n
+        ),
+        "hour": np.fromiter(
+            (r.timestamp.hour for r in records), np.float64, count=n
+        ),
+        "weekday": np.fromiter(
+            (r.timestamp.weekday() for r in records), np.float64, count=n
+        ),
+    }
+
+
+def _empty_forecast() -> Tuple[np.ndarray, np.ndarray]:
+    """
+    予測を行わない場合の空の予測結果を生成する
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        空の予測日付と予測体重の配列
+    """
+    return np.array([], dtype="datetime64[s]"), np.array([])
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fit_and_predict(
+    columns: Dict[str, np.ndarray], days: int = 30
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    体重記録から予測モデルを学習し、将来の体重を予測する (1時間キャッシュ)
+
+    記録の内容をキャッシュキーとするため、記録が変わらない限り
+    再実行時にモデルを再学習しない
+
+    Parameters
+    ----------
+    columns : Dict[str, np.ndarray]
+        _records_to_columnsで変換した体重記録
+    days : int, optional
+        予測日数, by default 30
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        予測日付 (datetime64[s]) と予測体重 (float64) の配列
+    """
+    X, y = WeightVisualizer._prepare_data(columns)
+    return WeightVisualizer._predict_future(X, y, days)
 
 
 class WeightVisualizer:
@@ -43,75 +125,104 @@ class WeightVisualizer:
         self.end_date = end_date
         self.show_prediction = show_prediction
 
-        # 表示用のデータをフィルタリング
-        self.display_record1 = [
-            r for r in records1 if start_date <= r.timestamp <= end_date
-        ]
-        self.display_record2 = [
-            r for r in records2 if start_date <= r.timestamp <= end_date
-        ]
+        # 記録を列ごとの配列に一度だけ変換する
+        self._cols1 = _records_to_columns(records1)
+        self._cols2 = _records_to_columns(records2)
+
+        # 表示用のデータを切り出す (記録は日時順に並んでいるため二分探索)
+        self._display_cols1 = self._slice_period(
+            self._cols1, start_date, end_date
+        )
+        self._display_cols2 = self._slice_period(
+            self._cols2, start_date, end_date
+        )
+
+    @staticmethod
+    def _slice_period(
+        columns: Dict[str, np.ndarray],
+        start_date: datetime,
+        end_date: datetime,
+    ) -> Dict[str, np.ndarray]:
+        """
+        日時順に並んだ記録から表示期間内の記録を切り出す
 
+        Parameters
+        ----------
+        columns : Dict[str, np.ndarray]
+            _records_to_columnsで変換した体重記録
+        start_date : datetime
+            表示開始日
+        end_date : datetime
+            表示終了日
+
+        Returns
+        -------
+        Dict[str, np.ndarray]
+            表示期間内の記録 (元の配列のビュー)
+        """
+        ts = columns["ts"]
+        lo = np.searchsorted(ts, start_date.timestamp(), side="left")
+        hi = np.searchsorted(ts, end_date.timestamp(), side="right")
+        return {key: values[lo:hi] for key, values in columns.items()}
+
+    @staticmethod
     def _prepare_data(
-        self, records: List[WeightRecord]
+        columns: Dict[str, np.ndarray],
     ) -> Tuple[np.ndarray, np.ndarray]:
         """
         特徴量の生成と前処理
 
         Parameters
         ----------
-        records : List[WeightRecord]
-            体重記録リスト
+        columns : Dict[str, np.ndarray]
+            _records_to_columnsで変換した体重記録
 
         Returns
         -------
         Tuple[np.ndarray, np.ndarray]
             X (特徴量) と y (体重) のデータ
         """
-
-        if not records:
+        n = len(columns["ts"])
+        if n == 0:
             return np.array([]), np.array([])
 
-        # 特徴量の抽出
-        features = []
-        targets = []
-
-        for i, record in enumerate(records):
-            feature = [
-                (record.timestamp - datetime.now()).days,  # 経過日数
-                record.time_after_meal,  # 食後経過時間
-                record.timestamp.hour,  # 時刻
-                record.timestamp.weekday(),  # 曜日
-                np.sin(2 * np.pi * record.timestamp.hour / 24),  # 時刻の周期性
-                np.cos(2 * np.pi * record.timestamp.hour / 24),
-            ]
-
-            # 過去の体重変化率（可能な場合）
-            if i > 0:
-                prev_record = records[i - 1]  # 前回の記録を参照
-                weight_change = record.weight - prev_record.weight
-                days_diff = (record.timestamp - prev_record.timestamp).days
-                if days_diff > 0:
-                    feature.append(weight_change / days_diff)
-                else:
-                    feature.append(0)
-            else:
-                feature.append(0)
-
-            features.append(feature)
-            targets.append(record.weight)
+        ts = columns["ts"]
+        y = columns["weight"]
+        hours = columns["hour"]
+
+        # 過去の体重変化率 (前回の記録から1日以上経過している場合のみ)
+        days_diff = np.floor(np.diff(ts) / 86400)
+        weight_change = np.diff(y)
+        change_rate = np.zeros(n)
+        change_rate[1:] = np.where(
+            days_diff > 0,
+            weight_change / np.where(days_diff > 0, days_diff, 1),
+            0,
+        )
 
-        X = np.array(features)
-        y = np.array(targets)
+        # 経過日数
+        elapsed_days = np.floor((ts - datetime.now().timestamp()) / 86400)
 
-        # 特徴量の標準化
-        self.scaler = StandardScaler()
-        X = self.scaler.fit_transform(X)
+        # 特徴量の抽出
+        X = np.column_stack(
+            [
+                elapsed_days,  # 経過日数
+                columns["tam"],  # 食後経過時間
+                hours,  # 時刻
+                columns["weekday"],  # 曜日
+                np.sin(2 * np.pi * hours / 24),  # 時刻の周期性
+                np.cos(2 * np.pi * hours / 24),
+                change_rate,  # 過去の体重変化率
+            ]
+        )
 
+        # 決定木ベースのモデルはスケールに依存しないため標準化は不要
         return X, y
 
+    @staticmethod
     def _predict_future(
-        self, X: np.ndarray, y: np.ndarray, days: int = 30
-    ) -> Tuple[List[datetime], List[float]]:
+        X: np.ndarray, y: np.ndarray, days: int = 30
+    ) -> Tuple[np.ndarray, np.ndarray]:
         """
         勾配ブースティングを使用した高精度な予測
 
@@ -126,58 +237,136 @@ class WeightVisualizer:
 
         Returns
         -------
-        Tuple[List[datetime], List[float]]
-            予測日付と予測体重のリスト
+        Tuple[np.ndarray, np.ndarray]
+            予測日付 (datetime64[s]) と予測体重 (float64) の配列
         """
         if len(X) < 5:  # 最低5点のデータポイントが必要
-            return [], []
-
-        model = GradientBoostingRegressor(
-            n_estimators=100, learning_rate=0.1, max_depth=3, random_state=42
+            return _empty_forecast()
+
+        # scikit-learnの読み込みは重いため、予測を行う場合のみインポートする
+        from sklearn.ensemble import HistGradientBoostingRegressor
+
+        # ヒストグラムベースの勾配ブースティング
+        # (少数の記録でも分岐できるよう葉の最小サンプル数は1とする)
+        model = HistGradientBoostingRegressor(
+            max_iter=100,
+            learning_rate=0.1,
+            max_depth=3,
+            min_samples_leaf=1,
+            random_state=42,
         )
         model.fit(X, y)
 
-        future_dates = []
-        predictions = []
+        # 現在時刻は1回だけ取得し、予測日付をまとめて生成する
+        # (記録の日付と揃えるため、日本時間の壁時計時刻とする)
+        now = datetime.now(JST).replace(tzinfo=None)
+        day_offsets = np.arange(1, days + 1)
+        future_dates = np.datetime64(now, "s") + day_offsets.astype(
+            "timedelta64[D]"
+        )
+        weekdays = (now.weekday() + day_offsets) % 7
+        predictions = np.empty(days)
 
         last_weight = y[-1]
         last_change = 0
 
-        for day in range(1, days + 1):
-            future_date = datetime.now() + timedelta(days=day)
+        for i, day in enumerate(day_offsets):
             feature = [
                 day,  # 経過日数
                 2.0,  # デフォルトの食後経過時間
-                future_date.hour,
-                future_date.weekday(),
-                np.sin(2 * np.pi * future_date.hour / 24),
-                np.cos(2 * np.pi * future_date.hour / 24),
+                now.hour,
+                weekdays[i],
+                np.sin(2 * np.pi * now.hour / 24),
+                np.cos(2 * np.pi * now.hour / 24),
                 last_change,  # 過去の変化率
             ]
 
-            feature_scaled = self.scaler.transform([feature])
-            pred = model.predict(feature_scaled)[0]
+            pred = model.predict([feature])[0]
 
             # 予測値の安定化
             last_change = (pred - last_weight) / 1
             last_weight = pred
 
-            future_dates.append(future_date)
-            predictions.append(pred)
+            predictions[i] = pred
 
         return future_dates, predictions
 
-    def create_graph(self):
-        user1_name, user2_name = st.secrets["app"]["user_type"]
+    def _predict_all(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        両ユーザーの予測を並列に実行
+
+        予測表示がオフの場合や表示する記録がない場合は予測しない
+
+        Returns
+        -------
+        List[Tuple[np.ndarray, np.ndarray]]
+            ユーザー1・ユーザー2それぞれの予測日付 (datetime64[s]) と予測体重 (float64) の配列
+        """
+        # 全データを使用して予測
+        targets = [
+            columns if self.show_prediction and len(display["ts"]) else None
+            for columns, display in (
+                (self._cols1, self._display_cols1),
+                (self._cols2, self._display_cols2),
+            )
+        ]
+        if all(columns is None for columns in targets):
+            return [_empty_forecast(), _empty_forecast()]
+
+        def predict(
+            columns: Optional[Dict[str, np.ndarray]],
+        ) -> Tuple[np.ndarray, np.ndarray]:
+            if columns is None:
+                return _empty_forecast()
+            return _fit_and_predict(columns)
+
+        return run_parallel(predict, targets)
+
+    def _cache_key(self) -> Tuple:
+        """
+        グラフの内容を決める値をまとめたキャッシュキーを生成
+
+        Returns
+        -------
+        Tuple
+            記録の内容・表示期間・予測表示フラグ
+        """
+        return (
+            self.show_prediction,
+            self.start_date.timestamp(),
+            self.end_date.timestamp(),
+            *(
+                columns[name].tobytes()
+                for columns in (self._cols1, self._cols2)
+                for name in ("ts", "weight", "tam")
+            ),
+        )
+
+    def create_graph(self) -> go.Figure:
+        """
+        グラフを生成 (記録・表示期間・予測表示が同じ場合はキャッシュを返す)
+
+        Returns
+        -------
+        go.Figure
+            体重推移グラフ
+        """
+        return _build_figure(self)
+
+    def _create_graph(self) -> go.Figure:
+        user1_name, user2_name = USER_TYPES
         fig = make_subplots(rows=1, cols=1, specs=[[{"secondary_y": True}]])
+        (future_dates1, predictions1), (future_dates2, predictions2) = (
+            self._predict_all()
+        )
 
         # ユーザー1のデータプロット
-        if self.display_record1:
-            dates1 = [r.timestamp for r in self.display_record1]
-            weight1 = [r.weight for r in self.display_record1]
+        if len(self._display_cols1["ts"]):
+            dates1 = self._display_cols1["dates"]
+            weight1 = self._display_cols1["weight"]
 
             fig.add_trace(
-                go.Scatter(
+                go.Scattergl(
                     x=dates1,
                     y=weight1,
                     name=user1_name,
@@ -189,36 +378,26 @@ class WeightVisualizer:
             )
 
             # 予測の追加
-            if (
-                self.show_prediction and self.records1
-            ):  # 全データを使用して予測
-                X1, y1 = self._prepare_data(self.records1)
-                future_dates1, predictions1 = self._predict_future(X1, y1)
-
-                if predictions1:
-                    # 表示期間内の最新データから予測線を開始
-                    last_record = self.display_record1[-1]
-                    future_dates1.insert(0, last_record.timestamp)
-                    predictions1.insert(0, last_record.weight)
-
-                    fig.add_trace(
-                        go.Scatter(
-                            x=future_dates1,
-                            y=predictions1,
-                            name=f"{user1_name} (予測)",
-                            line=dict(color="blue", dash="dot"),
-                            hovertemplate="予測日: %{x}<br>予測体重: %{y:.1f}kg<br>",
-                        ),
-                        secondary_y=False,
-                    )
+            if len(predictions1):
+                # 表示期間内の最新データから予測線を開始
+                fig.add_trace(
+                    go.Scattergl(
+                        x=np.concatenate([dates1[-1:], future_dates1]),
+                        y=np.concatenate([weight1[-1:], predictions1]),
+                        name=f"{user1_name} (予測)",
+                        line=dict(color="blue", dash="dot"),
+                        hovertemplate="予測日: %{x}<br>予測体重: %{y:.1f}kg<br>",
+                    ),
+                    secondary_y=False,
+                )
 
         # ユーザー2のデータも同様にプロット
-        if self.display_record2:
-            dates2 = [r.timestamp for r in self.display_record2]
-            weights2 = [r.weight for r in self.display_record2]
+        if len(self._display_cols2["ts"]):
+            dates2 = self._display_cols2["dates"]
+            weights2 = self._display_cols2["weight"]
 
             fig.add_trace(
-                go.Scatter(
+                go.Scattergl(
                     x=dates2,
                     y=weights2,
                     name=user2_name,
@@ -230,28 +409,18 @@ class WeightVisualizer:
             )
 
             # 予測の追加
-            if (
-                self.show_prediction and self.records2
-            ):  # 全データを使用して予測
-                X2, y2 = self._prepare_data(self.records2)
-                future_dates2, predictions2 = self._predict_future(X2, y2)
-
-                if predictions2:
-                    # 表示期間内の最新データから予測線を開始
-                    last_record = self.display_record2[-1]
-                    future_dates2.insert(0, last_record.timestamp)
-                    predictions2.insert(0, last_record.weight)
-
-                    fig.add_trace(
-                        go.Scatter(
-                            x=future_dates2,
-                            y=predictions2,
-                            name=f"{user2_name} (予測)",
-                            line=dict(color="red", dash="dot"),
-                            hovertemplate="予測日: %{x}<br>予測体重: %{y:.1f}kg<br>",
-                        ),
-                        secondary_y=False,
-                    )
+            if len(predictions2):
+                # 表示期間内の最新データから予測線を開始
+                fig.add_trace(
+                    go.Scattergl(
+                        x=np.concatenate([dates2[-1:], future_dates2]),
+                        y=np.concatenate([weights2[-1:], predictions2]),
+                        name=f"{user2_name} (予測)",
+                        line=dict(color="red", dash="dot"),
+                        hovertemplate="予測日: %{x}<br>予測体重: %{y:.1f}kg<br>",
+                    ),
+                    secondary_y=False,
+                )
 
         # グラフのレイアウト設定
         fig.update_layout(
@@ -268,3 +437,28 @@ class WeightVisualizer:
         """グラフを描画"""
         fig = self.create_graph()
         st.plotly_chart(fig, use_container_width=True)
+
+
+@st.cache_data(
+    ttl=600,
+    show_spinner=False,
+    hash_funcs={WeightVisualizer: WeightVisualizer._cache_key},
+)
+def _build_figure(visualizer: WeightVisualizer) -> go.Figure:
+    """
+    グラフを生成する (10分キャッシュ)
+
+    無関係なウィジェット操作による再実行では、
+    予測とグラフの構築を省略してキャッシュ済みのグラフを返す
+
+    Parameters
+    ----------
+    visualizer : WeightVisualizer
+        描画するデータを持つインスタンス
+
+    Returns
+    -------
+    go.Figure
+        体重推移グラフ
+    """
+    return visualizer._create_graph()